@@ -4,29 +4,26 @@
 
 import streamlit as st
 from openai import OpenAI
-import json
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import hashlib
+import httpx
+import orjson
 import os
+import pyarrow as pa
+import threading
+import tiktoken
 import time # 시뮬레이션 지연용
 
 # -------------------------------------------------------
 # 1. 클라이언트 초기화 함수 (st.secrets 사용)
 # -------------------------------------------------------
 
-# app.py 파일 내 get_openai_client 함수
 @st.cache_resource
-def get_openai_client():
-    
-    try:
-        # 💥 반드시 MY_OPENAI_KEY를 읽도록 수정합니다. 💥
-        api_key = st.secrets["secrets"]["MY_OPENAI_KEY"].strip() 
-    except KeyError:
-        st.error("오류: Streamlit Secrets에 [secrets] 섹션 또는 MY_OPENAI_KEY가 누락되었습니다.")
-        st.stop()
-        
-    # ... (나머지 로직)
-    return OpenAI(api_key=api_key)
-def get_openai_client():
-    """Streamlit Secrets에서 API 키를 읽어 OpenAI 클라이언트를 초기화합니다."""
+def _load_and_validate_key() -> str:
+    """Streamlit Secrets에서 API 키를 읽고 검증합니다. (프로세스당 한 번만 실행)"""
     
     # st.secrets 객체에서 API 키 값을 가져옵니다.
     try:
@@ -42,39 +39,143 @@ def get_openai_client():
     if not api_key or not api_key.startswith("sk-"):
         st.error("오류: API 키 (OPENAI_API_KEY)의 값이 유효하지 않습니다. Secrets 설정을 확인해주세요.")
         st.stop()
+    
+    return api_key
+
+# 스크립트 재실행 시에는 캐시된 값을 그대로 사용 (키가 잘못되면 여기서 앱 실행을 중단)
+_API_KEY = _load_and_validate_key()
+
+@st.cache_resource
+def get_openai_client():
+    """검증된 API 키와 연결 풀을 재사용하는 OpenAI 클라이언트를 초기화합니다."""
+    
+    # 에이전트 턴마다 TLS 연결을 새로 맺지 않도록 keepalive 연결 풀을 재사용합니다.
+    # (transport를 직접 넘기면 Client의 limits/http2 인자는 무시되므로 transport에 설정)
+    transport = httpx.HTTPTransport(
+        retries=2,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60.0),
+    )
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0),
+        transport=transport,
+    )
+    atexit.register(http_client.close)
         
-    return OpenAI(api_key=api_key)
+    return OpenAI(api_key=_API_KEY, http_client=http_client)
+
+@st.cache_resource
+def get_data_portal_client():
+    """공공데이터포털 API용 httpx 클라이언트를 초기화합니다. (모든 Tool이 하나의 연결 풀을 공유)"""
+    http_client = httpx.Client(
+        base_url="https://api.data.go.kr",
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=10.0,
+        http2=True,
+    )
+    atexit.register(http_client.close)
+    return http_client
+
+@st.cache_resource
+def get_tool_executor():
+    """Tool 실행용 스레드 풀을 초기화합니다. (TOOL_CONCURRENCY_LIMIT로 동시 실행 수 제한)"""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(os.getenv("TOOL_CONCURRENCY_LIMIT", "4")),
+        thread_name_prefix="agent-tool",
+    )
+
+@st.cache_resource
+def get_token_encoder():
+    """
+    gpt-4o-mini 토크나이저를 한 번만 로드합니다.
+    (첫 로드 시 인코딩 파일을 내려받으므로, 실패하면 None을 반환해 글자 수 어림으로 대체)
+    """
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except Exception:
+        return None
+
+@st.cache_resource
+def _start_client_warmup():
+    """첫 클릭 전에 백그라운드에서 클라이언트와 토크나이저 캐시를 미리 채웁니다. (프로세스당 한 번만 스레드 시작)"""
+    def warmup():
+        get_openai_client()
+        get_data_portal_client()
+        get_token_encoder()
+    
+    thread = threading.Thread(target=warmup, name="client-warmup", daemon=True)
+    thread.start()
+    return thread
+
+_start_client_warmup()
 
 # -------------------------------------------------------
 # 2. Tool 함수 정의 (MCP 기능, Mock API)
 # -------------------------------------------------------
 
-def get_heritage_text_record(location: str, structure_name: str) -> str:
+def simulate_latency(default_delay: float):
+    """AGENT_SIMULATE_LATENCY가 설정된 경우에만 API 지연을 흉내냅니다. (AGENT_SIM_DELAY로 지연 시간 지정)"""
+    if os.getenv("AGENT_SIMULATE_LATENCY"):
+        time.sleep(float(os.getenv("AGENT_SIM_DELAY", default_delay)))
+
+@st.cache_data(ttl="1h", max_entries=256, show_spinner=False)
+def fetch_portal_heritage_record(location: str, structure_name: str, service_key: str) -> dict:
+    """
+    공공데이터포털에서 역사 기록을 조회합니다.
+    HTTP 오류, JSON이 아닌 응답, Mock과 같은 형태(status="success", text_record 문자열)가
+    아닌 응답은 모두 예외로 올려 보내므로 정상 기록만 캐시됩니다.
+    """
+    response = get_data_portal_client().get(
+        "/heritage/search",
+        params={"serviceKey": service_key, "location": location, "name": structure_name},
+    )
+    response.raise_for_status()
+    payload = response.json()
+    
+    # 포털의 JSON 오류 응답(미등록 키, 검색 결과 없음 등)도 캐시되지 않도록 예외 처리
+    if not isinstance(payload, dict) or payload.get("status") != "success" or not isinstance(payload.get("text_record"), str):
+        raise ValueError(f"예상하지 못한 응답 형식입니다: {str(payload)[:200]}")
+    return payload
+
+def get_heritage_text_record(location: str, structure_name: str) -> dict:
     """
     특정 지역과 구조물의 이름으로 역사 기록 텍스트를 검색하는 Tool입니다.
-    (실제로는 공공데이터포털 API를 호출해야 합니다.)
+    (DATA_PORTAL_SERVICE_KEY가 설정되면 공공데이터포털 API를, 아니면 Mock 데이터를 사용합니다.)
     """
-    time.sleep(1) # 시뮬레이션 지연
+    service_key = os.getenv("DATA_PORTAL_SERVICE_KEY")
+    if service_key:
+        try:
+            return fetch_portal_heritage_record(location, structure_name, service_key)
+        except (httpx.HTTPError, ValueError) as e:
+            # ValueError: JSON이 아닌 응답 (포털은 오류도 200 + XML 본문으로 보내는 경우가 많음)
+            return {"status": "error", "text_record": f"'{structure_name}' 기록 검색 API 호출에 실패했습니다: {e}"}
+    return get_mock_heritage_text_record(location, structure_name)
+
+@st.cache_data(ttl="1h", max_entries=256, show_spinner=False)
+def get_mock_heritage_text_record(location: str, structure_name: str) -> dict:
+    """Mock 역사 기록을 반환합니다."""
+    simulate_latency(1.0) # 시뮬레이션 지연
     
     if "홍길동" in structure_name:
-        return json.dumps({
+        return {
             "status": "success",
             "search_term": structure_name,
             "text_record": "홍길동 작가는 1920년대 초 일본에서 유학했으며, 당시 파리 화단의 추상적 경향에 영향을 받았으나, 귀국 후 조선미술전람회에서 '조선의 풍경'을 테마로 한 실험적인 단색화(Monochrome)를 주로 선보였다. 초기에는 채색화도 병행했으나, 후기에는 캔버스에 마포를 사용한 물성 위주 작업에 집중했다.",
             "exhibition_count": 5
-        })
-    return json.dumps({"status": "error", "text_record": f"'{structure_name}'에 대한 상세 기록을 찾을 수 없습니다."})
+        }
+    return {"status": "error", "text_record": f"'{structure_name}'에 대한 상세 기록을 찾을 수 없습니다."}
 
-def generate_visualization_data(data: str, visualization_type: str) -> str:
+@st.cache_data(ttl="1h", max_entries=256, show_spinner=False)
+def generate_visualization_data(data: str, visualization_type: str) -> dict:
     """
     분석된 데이터를 기반으로 시각화 자료(JSON)를 생성하는 Tool입니다.
     (실제로는 데이터 프레임을 처리하고 Plotly JSON을 반환해야 합니다.)
     """
-    time.sleep(1.5) # 시뮬레이션 지연
+    simulate_latency(1.5) # 시뮬레이션 지연
     
     if "단색화" in data and visualization_type == "timeline":
         # LLM이 분석한 내용을 시각화 JSON으로 변환했다고 가정
-        return json.dumps({
+        return {
             "status": "success",
             "visualization_type": "연표",
             "data": [
@@ -83,8 +184,8 @@ def generate_visualization_data(data: str, visualization_type: str) -> str:
                 {"year": 1930, "event": "조선미술전람회에서 마포 질감 위주 작품 발표"},
                 {"year": 1935, "event": "초기 채색화 활동 중단"}
             ]
-        })
-    return json.dumps({"status": "error", "message": "요청된 시각화 데이터를 생성할 수 없습니다."})
+        }
+    return {"status": "error", "message": "요청된 시각화 데이터를 생성할 수 없습니다."}
 
 # -------------------------------------------------------
 # 3. Tool 스키마 정의 및 딕셔너리
@@ -114,62 +215,341 @@ available_functions = {
     "generate_visualization_data": generate_visualization_data,
 }
 
+# 매 호출마다 같은 객체를 넘기도록 스키마를 한 번만 고정
+_TOOLS_CANONICAL = tuple(tools)
+# Tool 스키마가 바뀌면 캐시된 LLM 응답도 무효화되도록 캐시 키에 포함
+_TOOLS_SHA = hashlib.sha256(orjson.dumps(tools, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
 
 # -------------------------------------------------------
 # 4. 핵심 에이전트 실행 함수 (MCP 로직)
 # -------------------------------------------------------
 
-def run_master_agent(user_prompt: str, location: str, structure_name: str, viz_type: str):
+# Tool별로 받을 수 있는 인자 이름 (모델이 만든 인자에서 허용된 키만 넘기기 위함)
+_TOOL_PARAMETERS = {tool["function"]["name"]: set(tool["function"]["parameters"]["properties"]) for tool in tools}
+
+
+def _plan_call_schema(tool: dict) -> dict:
+    """Tool 하나에 대한 계획 항목 스키마 (strict 모드: 모든 인자 필수, 추가 키 금지)"""
+    properties = tool["function"]["parameters"]["properties"]
+    return {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "const": tool["function"]["name"]},
+            "arguments": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+        "required": ["name", "arguments"],
+        "additionalProperties": False,
+    }
+
+
+# 계획 수립 턴에서 사용하는 structured output 스키마 (호출할 Tool과 인자 목록)
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "calls": {
+            "type": "array",
+            "items": {"anyOf": [_plan_call_schema(tool) for tool in tools]},
+        },
+    },
+    "required": ["calls"],
+    "additionalProperties": False,
+}
+
+
+@st.cache_data(ttl="6h", max_entries=512, show_spinner=False)
+def cached_plan(messages_json: str, tools_hash: str) -> dict:
+    """
+    첫 턴(계획 수립) LLM 응답을 메시지 내용 기준으로 캐시합니다.
+    Tool 호출 대신 structured output으로 {"calls": [{name, arguments}, ...]} 계획을 받습니다.
+    (arguments는 Tool별 인자 스키마를 따르는 객체)
+    tools_hash는 캐시 키에만 쓰입니다.
+    """
+    client = get_openai_client()
+    planning_prompt = (
+        "다음 Tool 중 사용자 요청을 처리하는 데 필요한 호출을 실행 순서대로 계획하세요. "
+        "필요한 Tool이 없으면 calls를 빈 배열로 두세요.\n" + orjson.dumps(tools).decode()
+    )
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "system", "content": planning_prompt}, *orjson.loads(messages_json)],
+        response_format={"type": "json_schema", "json_schema": {"name": "plan", "schema": PLAN_SCHEMA, "strict": True}},
+    )
+    message = response.choices[0].message
+    # 모델이 계획을 거부(refusal)하거나 내용이 비면 빈 계획으로 처리해 Tool 호출 루프로 넘어감
+    if message.refusal or message.content is None:
+        return {"calls": []}
+    return orjson.loads(message.content)
+
+
+def _fastpath_timeline(location: str, structure_name: str, viz_type: str) -> dict:
+    """기본 요청의 고정된 Tool 순서(기록 검색 → 시각화)를 LLM 계획 없이 바로 실행합니다."""
+    record_obj = get_heritage_text_record(location, structure_name)
+    viz_obj = generate_visualization_data(record_obj.get("text_record", ""), viz_type)
+    return {"get_heritage_text_record": record_obj, "generate_visualization_data": viz_obj}
+
+
+def summarize_tool_results(client, user_prompt: str, tool_results: dict):
+    """
+    미리 수집한 Tool 결과를 근거로 최종 답변을 생성합니다. (Tool 없이 LLM 한 번 호출)
+    답변은 도착하는 대로 화면에 그릴 수 있도록 토큰 제너레이터로 반환합니다.
+    """
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "다음은 Tool로 미리 수집한 결과입니다. 이 결과를 근거로 사용자 요청에 답하세요.\n" + orjson.dumps(tool_results).decode()},
+            {"role": "user", "content": user_prompt},
+        ],
+        stream=True,
+    )
+    
+    def tokens():
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    
+    return tokens()
+
+
+# 누적 프롬프트가 이 토큰 수를 넘으면 Tool 루프를 중단
+MAX_PROMPT_TOKENS = int(os.getenv("AGENT_MAX_PROMPT_TOKENS", "8000"))
+
+
+def count_prompt_tokens(messages: list) -> int:
+    """누적 메시지의 토큰 수를 셉니다. 토크나이저를 쓸 수 없으면 글자 수로 어림합니다."""
+    payload = orjson.dumps(messages).decode()
+    encoder = get_token_encoder()
+    if encoder is None:
+        return len(payload) // 3
+    return len(encoder.encode(payload))
+
+
+# 압축된 tool 메시지 표시 (다시 압축하지 않도록 content 앞부분으로 판별)
+_COMPACTED_PREFIX = '{"_compacted":true'
+
+
+def compact_messages(messages: list, keep_recent: int = 2):
+    """
+    대화가 길어지면 오래된 tool 결과를 앞 200자 요약으로 줄여, 매 턴 다시 전송되는
+    프롬프트 크기를 제한합니다. 최근 keep_recent개의 tool 결과는 그대로 둡니다.
+    """
+    if len(messages) <= 6:
+        return
+    
+    tool_messages = [message for message in messages if message["role"] == "tool"]
+    for message in tool_messages[:-keep_recent]:
+        if message["content"].startswith(_COMPACTED_PREFIX):
+            continue
+        message["content"] = orjson.dumps({"_compacted": True, "summary": message["content"][:200]}).decode()
+
+
+# UI가 기본으로 채워 주는 분석 요청 문구 (빠른 경로 판별에도 사용)
+DEFAULT_PROMPT_TEMPLATE = "'{structure_name}'의 역사 기록을 검색하고, 그 기록을 바탕으로 주요 활동 시기를 '{viz_type}' 형식으로 시각화할 수 있도록 분석해 줘."
+
+
+def _is_complete_arguments(arguments: str) -> bool:
+    """스트리밍 중인 tool_call 인자 문자열이 완결된 JSON인지 확인합니다."""
+    try:
+        orjson.loads(arguments)
+    except orjson.JSONDecodeError:
+        return False
+    return True
+
+
+def _parse_tool_arguments(function_name: str, arguments: str) -> dict:
+    """모델이 만든 인자 JSON을 dict로 바꾸고, Tool이 받지 않는 키는 버립니다. (dict가 아니면 빈 인자)"""
+    parsed = orjson.loads(arguments)
+    if not isinstance(parsed, dict):
+        return {}
+    return {key: value for key, value in parsed.items() if key in _TOOL_PARAMETERS[function_name]}
+
+
+async def stream_completion(client, messages: list, on_tool_call, tool_choice: str = "auto") -> tuple:
+    """
+    LLM 응답을 스트리밍으로 받으면서, 인자가 완성된 tool_call은 응답 디코딩이
+    끝나기 전에 on_tool_call로 넘겨 Tool 실행을 앞당깁니다.
+    (content, tool_calls)를 반환하며 tool_calls는 index 순서의 dict 목록입니다.
+    """
+    # 동기 클라이언트의 네트워크 대기는 스레드에서 처리해 이벤트 루프가 Tool 작업을 진행하도록 함
+    stream = await asyncio.to_thread(
+        client.chat.completions.create,
+        model="gpt-4o-mini",
+        messages=messages,
+        tools=_TOOLS_CANONICAL,
+        tool_choice=tool_choice,
+        stream=True,
+    )
+    chunks = iter(stream)
+    content_parts = []
+    calls = {}
+    launched = set()
+    
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content_parts.append(delta.content)
+        
+        for tc in delta.tool_calls or []:
+            call = calls.setdefault(tc.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+            if tc.id:
+                call["id"] = tc.id
+            if tc.function and tc.function.name:
+                call["function"]["name"] += tc.function.name
+            if tc.function and tc.function.arguments:
+                call["function"]["arguments"] += tc.function.arguments
+            
+            if tc.index not in launched and call["id"] and _is_complete_arguments(call["function"]["arguments"]):
+                launched.add(tc.index)
+                on_tool_call(call)
+    
+    # 스트림 도중 시작하지 못한 tool_call은 마지막에 실행
+    tool_calls = [calls[index] for index in sorted(calls)]
+    for index in sorted(calls):
+        if index not in launched:
+            on_tool_call(calls[index])
+    
+    return "".join(content_parts) or None, tool_calls
+
+
+async def run_master_agent(user_prompt: str, location: str, structure_name: str, viz_type: str):
+    """
+    사용자 요청을 처리하고 (최종 답변 스트림, Tool 결과)를 반환합니다.
+    최종 답변은 st.write_stream에 바로 넘길 수 있는 텍스트 조각 iterable입니다.
+    """
     
     client = get_openai_client() # 클라이언트 객체 가져오기
     messages = [{"role": "user", "content": user_prompt}]
     tool_results = {}
+    last_content = None
+    
+    # 기본 요청 문구의 연표/차트 분석은 "기록 검색 → 시각화" 순서가 정해져 있으므로
+    # LLM에게 Tool 계획을 묻지 않고 바로 실행한 뒤, 요약용 LLM 호출 한 번만 수행
+    if viz_type in ("연표", "차트") and user_prompt.strip() == DEFAULT_PROMPT_TEMPLATE.format(structure_name=structure_name, viz_type=viz_type):
+        st.info("기본 분석 요청이므로 기록 검색과 시각화를 바로 실행합니다.")
+        tool_results = _fastpath_timeline(location, structure_name, viz_type)
+        return summarize_tool_results(client, user_prompt, tool_results), tool_results
     
     st.info("AI 에이전트가 요청을 분석하고 Tool 호출 계획을 수립합니다.")
     
-    for i in range(3): # 최대 3번의 Tool 호출 기회 부여
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=tools,
-            tool_choice="auto",
+    # 현재 턴에 시작된 Tool 작업들과, 그중 기록 검색 작업들
+    turn_tasks = []
+    record_tasks = []
+    
+    # 같은 인자로 반복되는 Tool 호출(오류 루프) 감지용
+    seen_calls: set[tuple[str, bytes]] = set()
+    duplicate_detected = False
+    
+    async def dispatch(tool_call: dict):
+        nonlocal duplicate_detected
+        function_name = tool_call["function"]["name"]
+        function_args = _parse_tool_arguments(function_name, tool_call["function"]["arguments"])
+        
+        # get_heritage_text_record 호출 시, UI 입력값 전달
+        if function_name == "get_heritage_text_record":
+            function_args['location'] = location
+            function_args['structure_name'] = structure_name
+        
+        # generate_visualization_data 호출 시, 이전 검색 결과와 시각화 타입 전달
+        # (같은 턴에 기록 검색이 먼저 호출되었다면 그 결과를 기다렸다가 사용, 중복 차단된 검색은 결과 None)
+        elif function_name == "generate_visualization_data":
+            record_obj = None
+            for record_task in list(record_tasks):
+                _, _, obj = await record_task
+                if obj is not None:
+                    record_obj = obj
+            if record_obj is None:
+                record_obj = tool_results.get("get_heritage_text_record", {})
+            function_args['data'] = record_obj.get("text_record", "")
+            function_args['visualization_type'] = viz_type
+        
+        # UI 값이 반영된 실제 인자가 이미 실행된 것과 같으면 다시 실행하지 않음 (결과 None)
+        call_key = (function_name, orjson.dumps(function_args, option=orjson.OPT_SORT_KEYS))
+        if call_key in seen_calls:
+            duplicate_detected = True
+            st.warning(f"STEP {i+1}: ⚠️ Tool '{function_name}'의 중복 호출을 차단했습니다.")
+            return tool_call["id"], function_name, None
+        seen_calls.add(call_key)
+        
+        st.warning(f"STEP {i+1}: 🛠️ 에이전트가 Tool '{function_name}'을(를) 호출합니다.")
+        
+        # Tool은 캐시된 동기 함수이므로 공유 스레드 풀에서 실행해 다른 Tool과 겹치게 함
+        function_response_obj = await asyncio.get_running_loop().run_in_executor(
+            get_tool_executor(), functools.partial(available_functions[function_name], **function_args)
         )
         
-        response_message = response.choices[0].message
+        return tool_call["id"], function_name, function_response_obj
+    
+    def launch(tool_call: dict):
+        task = asyncio.create_task(dispatch(tool_call))
+        if tool_call["function"]["name"] == "get_heritage_text_record":
+            record_tasks.append(task)
+        turn_tasks.append(task)
+    
+    # 계획 수립 턴: structured output으로 받은 계획을 한 번에 동시 실행하고 요약만 LLM에 요청
+    # (계획된 호출은 인자가 모두 정해져 있으므로 Tool 호출 루프를 건너뜀)
+    messages_json = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS).decode()
+    plan = cached_plan(messages_json, _TOOLS_SHA)
+    if plan["calls"]:
+        i = 0 # 계획 실행은 STEP 1로 표시
+        for index, call in enumerate(plan["calls"]):
+            arguments = orjson.dumps(call["arguments"]).decode()
+            launch({"id": f"plan-{index}", "type": "function", "function": {"name": call["name"], "arguments": arguments}})
+        for _, function_name, function_response_obj in await asyncio.gather(*turn_tasks):
+            if function_response_obj is not None:
+                tool_results[function_name] = function_response_obj
+        return summarize_tool_results(client, user_prompt, tool_results), tool_results
+    
+    # 계획이 비어 있으면 일반 Tool 호출 루프로 진행
+    for i in range(4): # 최대 4번의 LLM 턴 (마지막 턴에서 최종 답변 기대)
+        turn_tasks.clear()
+        record_tasks.clear()
+        
+        # 스트리밍 중에 인자가 완성된 Tool은 바로 실행 시작
+        # 중복 호출이 감지된 뒤에는 Tool 없이 최종 답변만 하도록 강제
+        tool_choice = "none" if duplicate_detected else "auto"
+        content, tool_calls = await stream_completion(client, messages, launch, tool_choice)
+        
+        if content:
+            last_content = content
         
         # 1. 최종 텍스트 결과가 나오면 루프 종료
-        if not response_message.tool_calls:
-            return response_message.content, tool_results
+        if not tool_calls:
+            return [content or ""], tool_results
         
-        # 2. Tool Call 실행
-        messages.append(response_message)
+        # 2. Tool Call 실행 결과 수집 (같은 턴의 Tool들은 동시에 실행)
+        messages.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
+        results = await asyncio.gather(*turn_tasks)
         
-        for tool_call in response_message.tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
-            
-            st.warning(f"STEP {i+1}: 🛠️ 에이전트가 Tool '{function_name}'을(를) 호출합니다.")
-            
-            # get_heritage_text_record 호출 시, UI 입력값 전달
-            if function_name == "get_heritage_text_record":
-                function_args['location'] = location
-                function_args['structure_name'] = structure_name
-            
-            # generate_visualization_data 호출 시, 이전 검색 결과와 시각화 타입 전달
-            elif function_name == "generate_visualization_data":
-                record = tool_results.get("get_heritage_text_record", {}).get("text_record", "")
-                function_args['data'] = record
-                function_args['visualization_type'] = viz_type
-            
-            function_response = available_functions[function_name](**function_args)
-            
-            # 3. Tool 실행 결과를 저장하고 LLM에게 다시 전달 (Chain of Thought)
-            tool_results[function_name] = json.loads(function_response)
-            messages.append({"tool_call_id": tool_call.id, "role": "tool", "content": function_response})
+        # 3. Tool 실행 결과를 저장하고 LLM에게 다시 전달 (Chain of Thought)
+        # 실행 시작 순서와 관계없이 tool 메시지는 tool_calls 순서를 따름
+        results_by_id = {tool_call_id: (function_name, obj) for tool_call_id, function_name, obj in results}
+        for tool_call in tool_calls:
+            function_name, function_response_obj = results_by_id[tool_call["id"]]
+            if function_response_obj is None:
+                tool_content = "duplicate call suppressed"
+            else:
+                tool_results[function_name] = function_response_obj
+                tool_content = orjson.dumps(function_response_obj).decode()
+            messages.append({"tool_call_id": tool_call["id"], "role": "tool", "content": tool_content})
+        
+        # 오래된 tool 결과는 요약본으로 교체해 다음 턴의 전송량을 줄임
+        compact_messages(messages)
+        
+        # 누적 프롬프트가 예산을 넘으면 더 이상 LLM을 호출하지 않고 중단
+        prompt_tokens = count_prompt_tokens(messages)
+        if prompt_tokens > MAX_PROMPT_TOKENS:
+            st.warning(f"프롬프트가 {prompt_tokens} 토큰으로 한도({MAX_PROMPT_TOKENS})를 넘어 분석을 중단합니다.")
+            break
             
-    # 최종 응답 처리 (루프가 끝나도 최종 응답이 없을 경우)
-    final_response = client.chat.completions.create(model="gpt-4o-mini", messages=messages)
-    return final_response.choices[0].message.content, tool_results
+    # 루프가 끝나도 최종 응답이 없으면, 추가 LLM 호출 없이 마지막 assistant 텍스트를 반환
+    return [last_content or ""], tool_results
 
 
 # -------------------------------------------------------
@@ -192,7 +572,7 @@ with st.sidebar:
     
     prompt = st.text_area(
         "AI 분석 요청:", 
-        f"'{structure_name}'의 역사 기록을 검색하고, 그 기록을 바탕으로 주요 활동 시기를 '{viz_type}' 형식으로 시각화할 수 있도록 분석해 줘.",
+        DEFAULT_PROMPT_TEMPLATE.format(structure_name=structure_name, viz_type=viz_type),
         height=150
     )
 
@@ -202,11 +582,11 @@ if st.button("🔎 분석 및 시각화 실행"):
         with st.spinner("AI 에이전트가 기록 검색 및 시각화 명령을 진행 중입니다..."):
             
             # 6. run_master_agent 함수 호출
-            analysis_text, tool_results = run_master_agent(prompt, location, structure_name, viz_type)
+            analysis_stream, tool_results = asyncio.run(run_master_agent(prompt, location, structure_name, viz_type))
             
             # 7. 결과 출력
             st.subheader("💡 에이전트 최종 분석 및 스토리텔링")
-            st.write(analysis_text)
+            analysis_text = st.write_stream(analysis_stream)
             
             if "get_heritage_text_record" in tool_results:
                 record = tool_results["get_heritage_text_record"]
@@ -219,8 +599,8 @@ if st.button("🔎 분석 및 시각화 실행"):
                 if viz_data.get("status") == "success" and viz_data.get("visualization_type") == "연표":
                     st.subheader("📊 활동 연표 시각화 결과")
                     
-                    # Mock 연표 데이터 Streamlit 테이블로 출력
-                    df = st.dataframe(viz_data["data"], use_container_width=True)
+                    # Mock 연표 데이터를 Arrow 테이블로 만들어 Streamlit 테이블로 출력 (pandas 변환 생략)
+                    df = st.dataframe(pa.Table.from_pylist(viz_data["data"]), use_container_width=True)
                     st.markdown("_(실제 프로젝트에서는 Plotly/Altair를 사용하여 인터랙티브한 그래프를 여기에 표시할 수 있습니다.)_")
 
     else: